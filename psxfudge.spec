@@ -6,9 +6,10 @@ def _addExecutable(name, script):
 	module, func = script.split(":", 1)
 	launcher     = Path(workpath).joinpath(f"{name}.py")
 
-	# Ugly workaround, but it works.
+	# Ugly workaround, but it works. freeze_support() must be called before
+	# anything else for multiprocessing to work in frozen executables.
 	with launcher.open("wt") as _file:
-		_file.write(f"from {module} import {func}\n{func}()\n")
+		_file.write(f"from multiprocessing import freeze_support\nfreeze_support()\nfrom {module} import {func}\n{func}()\n")
 
 	analysis   = Analysis(( launcher, ))
 	executable = EXE(
@@ -273,12 +273,28 @@ class BundleBuilder(IndexBuilder):
 		self.addEntry(name, data, EntryType.STRING_TABLE)
 
 	def _buildVRAM(self, *options, **kwOptions):
-		buckets = buildTexturePages(self.textureList, *options, **kwOptions)
+		# Pre-sort all textures by decreasing area and longest side. The packer
+		# tries several sorting criteria on its own, but as Python's sort is
+		# stable this makes them all break ties the same way (larger textures
+		# first). Textures with the same area and longest side are left in
+		# insertion order, i.e. the order of their frame headers in the bundle.
+		# Note that palettes are also placed in this order rather than in
+		# insertion order.
+		images = sorted(
+			self.textureList,
+			key     = lambda image: (
+				image.innerWidth * image.innerHeight,
+				max(image.innerWidth, image.innerHeight)
+			),
+			reverse = True
+		)
+
+		buckets = buildTexturePages(images, *options, **kwOptions)
 
+		# Pages are always contiguous arrays (see buildTexturePages()), so they
+		# can be appended directly without converting them to bytes first.
 		for page in chain(*buckets):
-			# FIXME: for some reason self.vramData.extend(page) only works if
-			# there are no pages that have been split off from a >64x256 atlas
-			self.vramData.extend(page.tobytes())
+			self.vramData.extend(page)
 
 		if len(self.vramData) > VRAM_DATA_SIZE:
 			raise RuntimeError("VRAM size limit exceeded")
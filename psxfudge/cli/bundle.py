@@ -11,7 +11,8 @@ from PIL        import Image
 from ..image    import convertImage
 from ..audio    import convertSound
 from ..builders import BundleBuilder
-from ..parsers  import importKeyValue, importImages
+from ..packer   import ATLAS_HEIGHT
+from ..parsers  import importKeyValue, importImages, loadImage
 from ..util     import unpackNibbles, iteratePaths, parseJSON, CaseDict
 from .common    import IMAGE_PROPERTIES, SOUND_PROPERTIES, \
 	STRING_TABLE_PROPERTIES, MultiEntryTool
@@ -32,6 +33,72 @@ class _FudgeBundle(MultiEntryTool):
 		self.addFileOptions()
 		self.addPackerOptions()
 
+		self._handlers = {
+			"texture":     self._addTexture,
+			"itexture":    self._addTexture,
+			"bg":          self._addBG,
+			"ibg":         self._addBG,
+			"sound":       self._addSound,
+			"stringtable": self._addStringTable,
+			"file":        self._addFile
+		}
+
+	def _addTexture(self, bundle, name, _from, entry, _type):
+		# Assume that the source file is a spritesheet containing multiple
+		# animated textures (importImages() also treats single images as
+		# spritesheets) and add each texture to the bundle separately.
+		for _name, frameList in importImages(_from, entry):
+			images = [
+				tuple(convertImage(frame, entry))
+				for frame in frameList
+			]
+
+			bundle.addTexture(
+				name.format(sprite = _name),
+				images,
+				_type == "itexture"
+			)
+
+	def _addBG(self, bundle, name, _from, entry, _type):
+		entry["bpp"] = 16
+
+		if len(_from) > 1:
+			logging.warning(f"({name}) more than one path specified, using only first path")
+
+		bundle.addBG(
+			name,
+			next(convertImage(loadImage(_from[0]), entry)),
+			int(entry["crop"][0]),
+			int(entry["crop"][1]),
+			_type == "ibg"
+		)
+
+	def _addSound(self, bundle, name, _from, entry, _type):
+		if len(_from) > 1:
+			logging.warning(f"({name}) more than one path specified, using only first path")
+
+		with av.open(str(_from[0]), "r") as _file:
+			bundle.addSound(name, convertSound(_file, entry))
+
+	def _addStringTable(self, bundle, name, _from, entry, _type):
+		bundle.addStringTable(
+			name,
+			importKeyValue(_from),
+			entry["encoding"],
+			int(entry["align"])
+		)
+
+	def _addFile(self, bundle, name, _from, entry, _type):
+		with open(entry["from"], "rb") as _file:
+			bundle.addFile(name, _file.read())
+
+	def _addCustom(self, bundle, name, _from, entry, _type):
+		if type(_type) is str:
+			_type = int(_type, 0)
+
+		with open(entry["from"], "rb") as _file:
+			bundle.addEntry(name, _file.read(), _type)
+
 	def run(self, args, entryList, defaults, forced):
 		bundle = BundleBuilder()
 		logging.info(f"processing {len(entryList)} entries")
@@ -51,64 +118,8 @@ class _FudgeBundle(MultiEntryTool):
 			# Add the asset to the bundle, preprocessing it if it's a texture or
 			# sound or importing it as-is in other cases. If the type does not
 			# match any known type, interpret it as a number.
-			match _type:
-				case "texture" | "itexture":
-					# Assume that the source file is a spritesheet containing
-					# multiple animated textures (importImages() also treats
-					# single images as spritesheets) and add each texture to the
-					# bundle separately.
-					for _name, frameList in importImages(_from, entry):
-						images = [
-							tuple(convertImage(frame, entry))
-							for frame in frameList
-						]
-
-						bundle.addTexture(
-							name.format(sprite = _name),
-							images,
-							_type == "itexture"
-						)
-
-				case "bg" | "ibg":
-					entry["bpp"] = 16
-
-					if len(_from) > 1:
-						logging.warning(f"({name}) more than one path specified, using only first path")
-
-					with Image.open(_from[0], "r") as _file:
-						bundle.addBG(
-							name,
-							next(convertImage(_file, entry)),
-							int(entry["crop"][0]),
-							int(entry["crop"][1]),
-							_type == "ibg"
-						)
-
-				case "sound":
-					if len(_from) > 1:
-						logging.warning(f"({name}) more than one path specified, using only first path")
-
-					with av.open(str(_from[0]), "r") as _file:
-						bundle.addSound(name, convertSound(_file, entry))
-
-				case "stringtable":
-					bundle.addStringTable(
-						name,
-						importKeyValue(_from),
-						entry["encoding"],
-						int(entry["align"])
-					)
-
-				case "file":
-					with open(entry["from"], "rb") as _file:
-						bundle.addFile(name, _file.read())
-
-				case _:
-					if type(_type) is str:
-						_type = int(_type, 0)
-
-					with open(entry["from"], "rb") as _file:
-						bundle.addEntry(name, _file.read(), _type)
+			handler = self._handlers.get(_type, self._addCustom)
+			handler(bundle, name, _from, entry, _type)
 
 		logging.info(f"added {len(bundle.entries)} items to bundle")
 
@@ -121,12 +132,25 @@ class _FudgeBundle(MultiEntryTool):
 		if args.dump_atlas:
 			# Place all generated texture pages side-by-side, convert the
 			# resulting image from 4bpp to grayscale (ignoring palettes) and
-			# save it to the given path.
-			pages     = tuple(chain(*buckets))
-			imageData = unpackNibbles(numpy.hstack(pages)) << 4
+			# save it to the given path. Each page is unpacked directly into
+			# its slot in a preallocated buffer.
+			width     = sum(page.shape[1] for page in chain(*buckets))
+			imageData = numpy.empty(( ATLAS_HEIGHT, width * 2 ), numpy.uint8)
+			offset    = 0
+
+			for page in chain(*buckets):
+				pageWidth = page.shape[1] * 2
+
+				imageData[:, offset:(offset + pageWidth)] = \
+					unpackNibbles(page, shift = 4)
+				offset += pageWidth
 
+			# The dump is only meant for inspection, so wrap the array without
+			# copying it and save it with the fastest compression settings.
 			try:
-				Image.fromarray(imageData, "L").save(args.dump_atlas)
+				Image.frombuffer(
+					"L", imageData.shape[::-1], imageData, "raw", "L", 0, 1
+				).save(args.dump_atlas, optimize = False, compress_level = 1)
 			except:
 				logging.warning(f"failed to save atlas dump to {args.dump_atlas}")
 
@@ -47,6 +47,8 @@ STRING_TABLE_PROPERTIES = {
 	"align":    4
 }
 
+LOGGING_FORMAT = "[%(funcName)-13s %(levelname)-7s] %(message)s"
+
 ## Private utilities
 
 def _getOutputFileDesc(placeholders):
@@ -195,7 +197,7 @@ class Tool:
 		args = self.parser.parse_args(argv)
 
 		logging.basicConfig(
-			format = "[%(funcName)-13s %(levelname)-7s] %(message)s",
+			format = LOGGING_FORMAT,
 			level  = (
 				logging.WARNING,
 				logging.INFO,    # -v
@@ -214,6 +216,34 @@ class Tool:
 				except:
 					self.parser.error(f"failed to parse properties from {_file.name}")
 		if args:
+			# Try to parse all values at once by joining them into a single JSON
+			# object. The pairs in the outermost object (which is decoded last)
+			# are checked against the keys, so malformed values can't end up
+			# assigned to other keys. If anything fails, fall back to parsing
+			# each value separately in order to find and report the invalid one.
+			try:
+				keys, values = zip(*( arg.split("=", 1) for arg in args ))
+				pairs        = []
+
+				def _hook(_pairs):
+					pairs[:] = _pairs
+					return dict(_pairs)
+
+				json.loads(
+					"{" + ",".join(
+						f"{json.dumps(key)}:{value}" for key, value in zip(keys, values)
+					) + "}",
+					object_pairs_hook = _hook
+				)
+
+				if tuple(key for key, _ in pairs) != keys:
+					raise ValueError("parsed keys do not match specified keys")
+
+				properties.update(pairs)
+				return properties
+			except ValueError:
+				pass
+
 			for arg in args:
 				try:
 					key, value      = arg.split("=", 1)
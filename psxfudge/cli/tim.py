@@ -2,12 +2,25 @@
 # (C) 2022-2023 spicyjpeg
 
 import logging
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib         import nullcontext
+from functools          import partial
+from os                 import cpu_count
+from pathlib            import Path
 
 from ..image   import convertImage
 from ..parsers import importImages
 from ..util    import iteratePaths
-from .common   import IMAGE_PROPERTIES, TIM_IMAGE_PROPERTIES, Tool
+from .common   import IMAGE_PROPERTIES, TIM_IMAGE_PROPERTIES, LOGGING_FORMAT, \
+	Tool
+
+## Worker process functions
+
+def _initWorker(level):
+	logging.basicConfig(format = LOGGING_FORMAT, level = level)
+
+def _convertFrame(properties, frame):
+	return tuple(convertImage(frame, properties))
 
 ## Tool classes
 
@@ -33,36 +46,61 @@ class _FudgeTIM(Tool):
 		))
 
 		# Ensure the placeholders are present in the output path if there are
-		# name, frame or mipmap level number conflicts.
+		# name, frame or mipmap level number conflicts. This is done ahead of
+		# time, before any frame is converted.
 		if len(images) > 1 and ("{name" not in outputPath):
 			self.parser.error("more than one image to convert but the output path doesn't contain a {name} placeholder")
+		if int(properties["mipLevels"]) > 1 and ("{mip" not in outputPath):
+			self.parser.error("more than one mipmap level to generate but the output path doesn't contain a {mip} placeholder")
 
 		for name, frames in images:
 			if len(frames) > 1 and ("{frame" not in outputPath):
 				self.parser.error(f"image '{name}' has more than one frame but the output path doesn't contain a {{frame}} placeholder")
 
-			logging.info(f"processing {name} (frames: {len(frames)})")
-
-			for index, frame in enumerate(frames):
-				mipLevels = tuple(convertImage(frame, properties))
-
-				if len(mipLevels) > 1 and ("{mip" not in outputPath):
-					self.parser.error(f"image '{name}' has more than one mipmap level but the output path doesn't contain a {{mip}} placeholder")
-
-				for mip, image in enumerate(mipLevels):
-					path  = Path(outputPath.format(
-						name  = name,
-						frame = index,
-						mip   = mip
-					))
-
-					image.x,  image.y  = int(x),  int(y)
-					image.px, image.py = int(px), int(py)
-
-					with path.open("wb") as _file:
-						_file.write(image.toTIM())
-
-				logging.info(f"saved {path.name}")
+		# Frames are converted in parallel by a pool of worker processes (at most
+		# one per CPU core and one per frame), as conversion and quantization are
+		# CPU-bound. All frames are submitted at once, while the main process
+		# only writes the results to files in order. A single frame is converted
+		# in the main process, as starting a pool would only add overhead.
+		numFrames = sum(len(frames) for _, frames in images)
+
+		if numFrames > 1:
+			executor = ProcessPoolExecutor(
+				max_workers = min(numFrames, cpu_count() or 1),
+				initializer = _initWorker,
+				initargs    = ( logging.getLogger().level, )
+			)
+			_map     = executor.map
+		else:
+			executor = nullcontext()
+			_map     = map
+
+		with executor:
+			results = [
+				( name, len(frames), _map(
+					partial(_convertFrame, properties), frames
+				) )
+				for name, frames in images
+			]
+
+			for name, count, frameList in results:
+				logging.info(f"processing {name} (frames: {count})")
+
+				for index, mipLevels in enumerate(frameList):
+					for mip, image in enumerate(mipLevels):
+						path  = Path(outputPath.format(
+							name  = name,
+							frame = index,
+							mip   = mip
+						))
+
+						image.x,  image.y  = int(x),  int(y)
+						image.px, image.py = int(px), int(py)
+
+						with path.open("wb") as _file:
+							image.writeTIM(_file)
+
+					logging.info(f"saved {path.name}")
 
 ## Exports
 
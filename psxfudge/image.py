@@ -9,13 +9,15 @@ object.
 """
 
 import math, logging
-from struct import Struct
-from enum   import IntEnum
+from struct    import Struct
+from enum      import IntEnum
+from functools import lru_cache
 
 import numpy
 from PIL      import Image
-from .util   import blitArray, cropArray, CaseDict
-from .native import quantizeImage, toPS1ColorSpace, toPS1ColorSpace2D
+from .util   import blitArray, cropArray, hashArray, CaseDict
+from .native import quantizeImage, toPS1ColorSpace2D, toPS1ColorSpaceGather, \
+	packNibbles2D
 
 ## Image wrapper class (used by texture packer)
 
@@ -28,6 +30,12 @@ TIM_HEADER_STRUCT  = Struct("< 2I")
 TIM_HEADER_VERSION = 0x10
 TIM_SECTION_STRUCT = Struct("< I 4H")
 
+_packTIMHeader  = TIM_HEADER_STRUCT.pack
+_packTIMSection = TIM_SECTION_STRUCT.pack
+
+# Bit 3 signals the presence of a palette section in the file
+TIM_BPP_MODES = { 4: 0x08, 8: 0x09, 16: 0x02 }
+
 class ImageFlags(IntEnum):
 	BPP_4          = 0 << 0
 	BPP_8          = 1 << 0
@@ -37,6 +45,16 @@ class ImageFlags(IntEnum):
 	HAS_MARGIN     = 1 << 4
 	FLIP           = 1 << 5
 
+BPP_FLAGS = {
+	4:  ImageFlags.BPP_4,
+	8:  ImageFlags.BPP_8,
+	16: ImageFlags.BPP_16
+}
+
+# Scratch buffer used by getPaletteHash(), large enough for an 8bpp palette.
+# Note that this makes getPaletteHash() non-reentrant.
+_paletteScratch = numpy.empty(256, numpy.uint16)
+
 class ImageWrapper:
 	"""
 	Wrapper class for converted images and palettes, holding metadata such as
@@ -83,7 +101,12 @@ class ImageWrapper:
 		else:
 			self.bpp = 4 if (palette.size <= 32) else 8
 
-	def getPackedSize(self, flip = False):
+		# The packer queries the packed size many times while searching for a
+		# free spot, so it's calculated once for both orientations.
+		self._packedSizes = \
+			self._calculatePackedSize(False), self._calculatePackedSize(True)
+
+	def _calculatePackedSize(self, flip):
 		scale = 16 // self.bpp
 
 		if flip:
@@ -95,6 +118,9 @@ class ImageWrapper:
 
 		return width, height
 
+	def getPackedSize(self, flip = False):
+		return self._packedSizes[bool(flip)]
+
 	def getPackedMaxWidth(self):
 		return max(self.getPackedSize(flip)[0] for flip in self.flipModes)
 
@@ -128,11 +154,7 @@ class ImageWrapper:
 		return (self.px // 16) | (self.py << 6)
 
 	def getFlags(self):
-		flags = {
-			4:  ImageFlags.BPP_4,
-			8:  ImageFlags.BPP_8,
-			16: ImageFlags.BPP_16
-		}[self.bpp]
+		flags = BPP_FLAGS[self.bpp]
 
 		if self.field is not None:
 			flags |= ImageFlags.INTERLACE_ODD if self.field \
@@ -145,17 +167,20 @@ class ImageWrapper:
 		return flags
 
 	def getHash(self):
-		return hash(self.data.tobytes())
+		return hashArray(self.data)
 
 	def getPaletteHash(self, preserveLSB = False):
 		# Drop the least significant bit of each color. As the hash is used for
 		# deduplication, this means palettes that are "similar" enough to other
-		# palettes will be removed from the atlas.
+		# palettes will be removed from the atlas. The masking is done into a
+		# shared scratch buffer to leave the actual palette untouched.
 		data = self.palette.view(numpy.uint16)
 		if not preserveLSB:
-			data &= 0xfbde
+			data = numpy.bitwise_and(
+				data, 0xfbde, out = _paletteScratch[0:data.size]
+			)
 
-		return hash(data.tobytes())
+		return hashArray(data)
 
 	def toInterlaced(self, field = 0):
 		# Note that the packing/blitting attributes are *not* preserved and the
@@ -176,31 +201,27 @@ class ImageWrapper:
 		else:
 			data = self.data
 
-		# Add padding on the left if any (this is the only way to get padding
-		# right with 4bpp images), then cast the rotated image to a byte array
-		# if it's 16bpp.
-		data = numpy.c_[
-			numpy.zeros(( data.shape[0], self.padding ), numpy.uint8),
-			data
-		]
-		data = numpy.ascontiguousarray(data).view(numpy.uint8)
-
 		# "Compress" 4bpp images by packing two pixels into each byte (NumPy
 		# has no native support for 4-bit arrays, so a full byte is used for
-		# each pixel even for <=16 colors). This is done by splitting the array
-		# into vertically interlaced odd/even columns (after padding to ensure
-		# the width is a multiple of 4) and binary OR-ing them after relocating
-		# the odd columns' values to the upper nibble.
+		# each pixel even for <=16 colors). This is done in a single pass by
+		# the native module, which also adds padding on the left if any (this
+		# is the only way to get padding right with 4bpp images) and pads the
+		# width to a multiple of 4.
 		if self.bpp == 4:
-			if (align := (data.shape[1] % 4)):
-				data = numpy.c_[
-					data,
-					numpy.zeros(( data.shape[0], 4 - align ), numpy.uint8)
-				]
+			return packNibbles2D(data, self.padding, 4)
+
+		# If there is no padding to add, the image can be returned as-is (cast
+		# to a byte array if it's 16bpp) as long as it's contiguous. Otherwise
+		# copy it into a zero-filled buffer with room for the padding.
+		if not self.padding:
+			return numpy.ascontiguousarray(data).view(numpy.uint8)
+
+		height, width = data.shape
 
-			data = data[:, 0::2] | (data[:, 1::2] << 4)
+		buffer = numpy.zeros(( height, self.padding + width ), data.dtype)
+		buffer[:, self.padding:] = data
 
-		return data
+		return buffer.view(numpy.uint8)
 
 	def blit(self, dest):
 		data = self.getPackedData()
@@ -211,12 +232,11 @@ class ImageWrapper:
 		data  = self.palette.view(numpy.uint8).reshape(( 1, width ))
 		blitArray(data, dest, ( self.py, self.px * 32 ))
 
-	def toTIM(self):
-		tim = bytearray(TIM_HEADER_STRUCT.pack(
-			TIM_HEADER_VERSION,
-			# Bit 3 signals the presence of a palette section in the file
-			{ 4: 0x08, 8: 0x09, 16: 0x02 }[self.bpp]
-		))
+	def _generateTIM(self):
+		# Each section is yielded as soon as it's generated, with the palette
+		# and image data passed as-is (no copies are made as NumPy arrays
+		# support the buffer protocol).
+		yield _packTIMHeader(TIM_HEADER_VERSION, TIM_BPP_MODES[self.bpp])
 
 		# Generate the palette section if any.
 		if self.bpp != 16:
@@ -224,26 +244,33 @@ class ImageWrapper:
 				logging.warning("palette X offset is not aligned to 16 pixels")
 
 			paletteData = self.palette.view(numpy.uint16)
-			tim.extend(TIM_SECTION_STRUCT.pack(
+			yield _packTIMSection(
 				TIM_SECTION_STRUCT.size + paletteData.size * 2,
 				self.px,
 				self.py,
 				paletteData.size,
 				1
-			))
-			tim.extend(paletteData)
+			)
+			yield paletteData
 
 		# Generate the image section.
 		imageData = self.getPackedData()
-		tim.extend(TIM_SECTION_STRUCT.pack(
+		yield _packTIMSection(
 			TIM_SECTION_STRUCT.size + imageData.size,
 			int(self.x),
 			int(self.y),
 			*self.getPackedSize()
-		))
-		tim.extend(imageData)
+		)
+		yield imageData
 
-		return tim
+	def writeTIM(self, _file):
+		for section in self._generateTIM():
+			_file.write(section)
+
+	def toTIM(self):
+		# bytes.join() sizes the output from all sections before copying them,
+		# so the whole file is built with a single allocation.
+		return b"".join(self._generateTIM())
 
 ## Image downscaler and quantizer
 
@@ -312,10 +339,37 @@ def _processExistingPalette(name, image, maxNumColors, customPalette):
 	logging.debug(f"({name}) image has valid {_numColors}-color palette, skipping quantization")
 
 	palette = Image.frombytes(image.palette.mode, ( numColors, 1 ), paletteData)
-	palette = numpy.array(palette.convert("RGBA"), numpy.uint8)
+	palette = numpy.asarray(palette.convert("RGBA"), numpy.uint8)
 	palette = palette.reshape(( _numColors, 4 ))
 
-	return palette, numpy.array(image, numpy.uint8)
+	return palette, numpy.asarray(image, numpy.uint8)
+
+@lru_cache(maxsize = 64)
+def _sortPalette(paletteData, numColors, lowerAlpha, upperAlpha, blackRepl):
+	# This function is called with the palette's raw bytes, so that the results
+	# can be cached and reused across mipmap levels and frames sharing the same
+	# palette (e.g. when using a fixed palette). The returned arrays are shared
+	# and must not be modified.
+	colors      = numpy.frombuffer(paletteData, numpy.uint8).reshape(( -1, 4 ))
+	paletteData = numpy.zeros(( numColors, 4 ), numpy.uint8)
+
+	paletteData[0:colors.shape[0]] = colors
+
+	# The pixel data is remapped through the inverse of the sorting
+	# permutation, which can be built with a single scatter.
+	mapping = paletteData.view(numpy.uint32).flatten().argsort()
+	inverse = numpy.empty(numColors, numpy.uint8)
+
+	inverse[mapping] = numpy.arange(numColors, dtype = numpy.uint8)
+
+	paletteData = toPS1ColorSpaceGather(
+		paletteData, mapping, lowerAlpha, upperAlpha, blackRepl
+	)
+
+	inverse.flags.writeable     = False
+	paletteData.flags.writeable = False
+
+	return inverse, paletteData
 
 def convertImage(image, options):
 	"""
@@ -354,7 +408,15 @@ def convertImage(image, options):
 	blackRepl |= (blackValue[2] & 31) << 10
 	blackRepl |= (blackValue[3] &  1) << 15
 
+	# When each mipmap level is half the size of the previous one, it can be
+	# generated by box filtering the previous level (which is much faster than
+	# resampling the full size image again).
+	useReduce   = (mipScale == 0.5) and (scaleMode != Image.NEAREST)
+	scaledImage = None
+
 	for mipLevel in range(mipLevels):
+		size = int(_image.width * scale), int(_image.height * scale)
+
 		# Throw an error if attempting to rescale an image that already has a
 		# palette, since indexed color images can only be scaled using nearest
 		# neighbor interpolation (and it generally doesn't make sense to do so).
@@ -363,17 +425,20 @@ def convertImage(image, options):
 			scaledImage = _image
 		elif _image.mode == "P":
 			raise RuntimeError(f"({name}) can't rescale indexed color image")
+		elif useReduce and (scaledImage is not None) and all(size) and \
+			(scaledImage.width  >= size[0] * 2) and \
+			(scaledImage.height >= size[1] * 2):
+			scaledImage = scaledImage.reduce(
+				2, ( 0, 0, size[0] * 2, size[1] * 2 )
+			)
 		else:
-			scaledImage = _image.resize((
-				int(_image.width  * scale),
-				int(_image.height * scale)
-			), scaleMode)
+			scaledImage = _image.resize(size, scaleMode)
 
 		if bpp == 16:
 			if scaledImage.mode == "P":
 				logging.warning(f"({name}) converting indexed color back to 16bpp")
 
-			imageData   = numpy.array(scaledImage.convert("RGBA"), numpy.uint8)
+			imageData   = numpy.asarray(scaledImage.convert("RGBA"), numpy.uint8)
 			imageData   = toPS1ColorSpace2D(imageData, *alphaRange, blackRepl)
 			paletteData = None
 		else:
@@ -385,7 +450,7 @@ def convertImage(image, options):
 			# with the desidered format (see above), quantize the image.
 			if imageData is None:
 				paletteData, imageData = quantizeImage(
-					numpy.array(scaledImage.convert("RGBA"), numpy.uint8),
+					numpy.asarray(scaledImage.convert("RGBA"), numpy.uint8),
 					numColors,
 					palette,
 					5, # PS1 color depth (15bpp = 5bpp per channel)
@@ -394,18 +459,13 @@ def convertImage(image, options):
 
 			# Pad the palette with null entries and sort it by each color's
 			# packed RGB value, remapping the pixel data accordingly.
-
-			paletteData = numpy.r_[
-				paletteData,
-				numpy.zeros(( numColors - paletteData.shape[0], 4 ), numpy.uint8)
-			]
-
-			mapping     = paletteData.view(numpy.uint32).flatten().argsort()
-			imageData   = mapping.argsort().astype(numpy.uint8)[imageData]
-			paletteData = toPS1ColorSpace(
-				paletteData[mapping], *alphaRange, blackRepl
+			inverse, paletteData = _sortPalette(
+				paletteData.tobytes(), numColors, *alphaRange, blackRepl
 			)
 
+			imageData   = inverse[imageData]
+			paletteData = paletteData.copy()
+
 		# Trim any empty borders around the image (but save the number of pixels
 		# trimmed when cropMode = "preserveMargin", so the margin can be
 		# restored when drawing the image). The padding option optionally adds a
@@ -3,12 +3,13 @@
 # cython: language_level=3, boundscheck=False, wraparound=False
 # (C) 2022 spicyjpeg
 
-from libc.stdint cimport *
+from libc.stdint  cimport *
+from libcpp.vector cimport vector
 
 import numpy
 cimport numpy
 
-cdef extern from "libimagequant.h":
+cdef extern from "libimagequant.h" nogil:
 	ctypedef struct liq_attr:
 		pass
 	ctypedef struct liq_color:
@@ -53,7 +54,7 @@ cdef extern from "libimagequant.h":
 ## Image quantization API (libimagequant bindings)
 
 def quantizeImage(
-	uint8_t[:, :, ::1] source,
+	const uint8_t[:, :, ::1] source,
 	int    maxColors   = 256,
 	object initPalette = None,
 	int    targetBPP   = 8,
@@ -78,8 +79,8 @@ def quantizeImage(
 	)
 
 	# Pass the given predefined palette (if any) to libimagequant.
-	cdef uint8_t[:, ::1] initPaletteData
-	cdef liq_color       color
+	cdef const uint8_t[:, ::1] initPaletteData
+	cdef liq_color             color
 
 	if initPalette is not None:
 		initPaletteData = initPalette
@@ -94,7 +95,14 @@ def quantizeImage(
 
 			liq_image_add_fixed_color(image, color)
 
-	if liq_image_quantize(image, attr, &result) != LIQ_OK:
+	# Quantization and remapping (including dithering) are done entirely by
+	# libimagequant, so the GIL can be released while they run.
+	cdef liq_error error
+
+	with nogil:
+		error = liq_image_quantize(image, attr, &result)
+
+	if error != LIQ_OK:
 		liq_image_destroy(image)
 		liq_attr_destroy(attr)
 
@@ -104,12 +112,15 @@ def quantizeImage(
 	cdef uint8_t[:, ::1] outputData = output
 
 	liq_set_dithering_level(result, ditherLevel)
-	if liq_write_remapped_image(
-		result,
-		image,
-		&outputData[0, 0],
-		source.shape[0] * source.shape[1]
-	) != LIQ_OK:
+	with nogil:
+		error = liq_write_remapped_image(
+			result,
+			image,
+			&outputData[0, 0],
+			source.shape[0] * source.shape[1]
+		)
+
+	if error != LIQ_OK:
 		liq_result_destroy(result)
 		liq_image_destroy(image)
 		liq_attr_destroy(attr)
@@ -138,12 +149,30 @@ def quantizeImage(
 # https://github.com/stenzek/duckstation/blob/master/src/core/gpu_types.h#L135
 # https://stackoverflow.com/a/9069480
 
-cdef inline int _channelToPS1(int value):
+cdef inline int _channelToPS1(int value) nogil:
 	return ((value * 249) + 1014) >> 11
 	#return ((value * value * 249) + 1014) >> 19
 
+cdef inline uint16_t _colorToPS1(
+	const uint8_t *color,
+	int           lowerAlphaThreshold,
+	int           upperAlphaThreshold,
+	int           blackValue
+) nogil:
+	cdef uint16_t value
+
+	if color[3] < lowerAlphaThreshold:
+		return 0x0000
+
+	value  = (color[3] <= upperAlphaThreshold) << 15
+	value |= _channelToPS1(color[0])
+	value |= _channelToPS1(color[1]) << 5
+	value |= _channelToPS1(color[2]) << 10
+
+	return value if value else <uint16_t> blackValue
+
 def toPS1ColorSpace(
-	uint8_t[:, ::1] source,
+	const uint8_t[:, ::1] source,
 	int lowerAlphaThreshold,
 	int upperAlphaThreshold,
 	int blackValue
@@ -151,28 +180,52 @@ def toPS1ColorSpace(
 	output = numpy.empty(( source.shape[0], ), numpy.uint16)
 	cdef uint16_t[::1] outputData = output
 
-	cdef uint16_t value
+	cdef Py_ssize_t index
 
-	for index in range(source.shape[0]):
-		value = 0x0000
+	with nogil:
+		for index in range(source.shape[0]):
+			outputData[index] = _colorToPS1(
+				&source[index, 0],
+				lowerAlphaThreshold,
+				upperAlphaThreshold,
+				blackValue
+			)
 
-		if source[index, 3] >= lowerAlphaThreshold:
-			value  = (source[index, 3] <= upperAlphaThreshold) << 15
-			value |= _channelToPS1(source[index, 0])
-			value |= _channelToPS1(source[index, 1]) << 5
-			value |= _channelToPS1(source[index, 2]) << 10
+	return output
 
-			if not value:
-				value = blackValue
+def toPS1ColorSpaceGather(
+	const uint8_t[:, ::1]  source,
+	const Py_ssize_t[::1] mapping,
+	int lowerAlphaThreshold,
+	int upperAlphaThreshold,
+	int blackValue
+):
+	# Equivalent to toPS1ColorSpace(source[mapping], ...), but without creating
+	# a reordered copy of the source array first.
+	output = numpy.empty(( mapping.shape[0], ), numpy.uint16)
+	cdef uint16_t[::1] outputData = output
+
+	cdef Py_ssize_t index
 
-		outputData[index] = value
+	for index in range(mapping.shape[0]):
+		if not (0 <= mapping[index] < source.shape[0]):
+			raise IndexError("mapping index out of bounds")
+
+	with nogil:
+		for index in range(mapping.shape[0]):
+			outputData[index] = _colorToPS1(
+				&source[mapping[index], 0],
+				lowerAlphaThreshold,
+				upperAlphaThreshold,
+				blackValue
+			)
 
 	return output
 
 # There probably is a way to declare functions that take n-dimensional arrays
 # as input. Whatever it is, it's probably harder than copypasting the function.
 def toPS1ColorSpace2D(
-	uint8_t[:, :, ::1] source,
+	const uint8_t[:, :, ::1] source,
 	int lowerAlphaThreshold,
 	int upperAlphaThreshold,
 	int blackValue
@@ -180,25 +233,469 @@ def toPS1ColorSpace2D(
 	output = numpy.empty(( source.shape[0], source.shape[1] ), numpy.uint16)
 	cdef uint16_t[:, ::1] outputData = output
 
-	cdef uint16_t value
+	cdef Py_ssize_t x, y
 
-	for y in range(source.shape[0]):
-		for x in range(source.shape[1]):
-			value = 0x0000
+	# The per-pixel conversion is shared with toPS1ColorSpace() through an
+	# inline function, so the whole loop can run without holding the GIL.
+	with nogil:
+		for y in range(source.shape[0]):
+			for x in range(source.shape[1]):
+				outputData[y, x] = _colorToPS1(
+					&source[y, x, 0],
+					lowerAlphaThreshold,
+					upperAlphaThreshold,
+					blackValue
+				)
 
-			if source[y, x, 3] >= lowerAlphaThreshold:
-				value  = (source[y, x, 3] <= upperAlphaThreshold) << 15
-				value |= _channelToPS1(source[y, x, 0])
-				value |= _channelToPS1(source[y, x, 1]) << 5
-				value |= _channelToPS1(source[y, x, 2]) << 10
+	return output
 
-				if not value:
-					value = blackValue
+## 4bpp image packing
 
-			outputData[y, x] = value
+def packNibbles2D(
+	const uint8_t[:, :] source,
+	int leftPadding = 0,
+	int alignment   = 4
+):
+	# Pad the image with the given number of empty columns on the left, then
+	# with more columns on the right until its width is a multiple of the
+	# alignment, and pack each pair of pixels into a byte (with the leftmost
+	# pixel in the lower nibble). Any stride is accepted for the source, so
+	# rotated views do not have to be copied beforehand.
+	cdef Py_ssize_t width = source.shape[1] + leftPadding
+	width = ((width + alignment - 1) // alignment) * alignment
+
+	output = numpy.zeros(( source.shape[0], width // 2 ), numpy.uint8)
+	cdef uint8_t[:, ::1] outputData = output
+
+	cdef Py_ssize_t x, y, offset
+
+	with nogil:
+		for y in range(source.shape[0]):
+			for x in range(source.shape[1]):
+				offset = x + leftPadding
+
+				outputData[y, offset >> 1] |= \
+					<uint8_t> (source[y, x] << ((offset & 1) * 4))
 
 	return output
 
+## Texture packing
+
+# This is the inner loop of the texture packer, called by packer.py for each
+# packing attempt. Images are passed as a set of arrays holding the packed size
+# for each of their flip modes, the width of the texture pages they will be
+# placed into. Empty spaces are stored as 16-bit fields, so each one takes up 8
+# bytes and scanning the list touches as little memory as possible.
+
+cdef struct _PackingSpace:
+	uint16_t x, y, width, height
+
+cdef inline bint _fitsInTexpage(int offset, int length, int texpageLength) nogil:
+	return ((offset % texpageLength) + length) <= texpageLength
+
+def attemptPacking(
+	const int32_t[:, :, ::1] sizes,
+	const uint8_t[:, ::1]    flipModes,
+	const uint8_t[::1]       numFlipModes,
+	const int32_t[::1]       texpageWidths,
+	int32_t[:, ::1]          output,
+	int  atlasWidth,
+	int  atlasHeight,
+	bint altSplit
+):
+	# sizes is a (images, 2, 2) array of ( width, height ) pairs for each flip
+	# mode and output is an (images, 3) array that is filled in with the
+	# ( x, y, flip ) placement of each image (flip = -1 if not packed).
+	cdef Py_ssize_t numImages = sizes.shape[0]
+
+	cdef Py_ssize_t image, flipIndex, index, lowestIndex
+	cdef int        width, height, marginX, marginY, padLeft, padTop
+	cdef int        offsetX, offsetY, lowestOffsetX, lowestOffsetY
+	cdef int        texpageWidth, numSplit
+	cdef bint       fitsLeft, fitsRight, fitsTop, fitsBottom
+	cdef int64_t    imageArea, margin, lowestMargin
+
+	if not (
+		flipModes.shape[0]     == numImages and
+		numFlipModes.shape[0]  == numImages and
+		texpageWidths.shape[0] == numImages and
+		output.shape[0]        == numImages and
+		output.shape[1]        >= 3
+	):
+		raise ValueError("all arrays must have the same number of images")
+	if not (0 <= atlasWidth <= 0xffff and 0 <= atlasHeight <= 0xffff):
+		raise ValueError("atlas dimensions must be in 0-65535 range")
+
+	for image in range(numImages):
+		if numFlipModes[image] > 2:
+			raise ValueError("images can have at most 2 flip modes")
+
+	# Start with a single empty space representing the entire atlas.
+	cdef vector[_PackingSpace] spaces
+	cdef _PackingSpace         space
+	cdef _PackingSpace         split[2]
+
+	spaces.push_back(_PackingSpace(0, 0, atlasWidth, atlasHeight))
+
+	cdef int64_t    area   = 0
+	cdef Py_ssize_t packed = 0
+
+	with nogil:
+		for image in range(numImages):
+			output[image, 2] = -1
+			texpageWidth     = texpageWidths[image]
+
+			for flipIndex in range(numFlipModes[image]):
+				width     = sizes[image, flipIndex, 0]
+				height    = sizes[image, flipIndex, 1]
+				imageArea = <int64_t> width * height
+
+				# Find the smallest available space the image can be placed
+				# into. This implementation is slightly different from
+				# rectpack2D as it always goes through all empty spaces, which
+				# is inefficient but might lead to better packing ratios, and
+				# ensures images are not placed in the middle of the atlas
+				# (where they'd be split across two different PS1 texture
+				# pages).
+				lowestIndex   = -1
+				lowestOffsetX = 0
+				lowestOffsetY = 0
+				lowestMargin  = INT64_MAX
+
+				for index in range(<Py_ssize_t> spaces.size()):
+					space = spaces[index]
+					if width > space.width or height > space.height:
+						continue
+
+					# Skip the space early if it's not any smaller than the
+					# best one found so far, as the corner checks below are
+					# more expensive than calculating the margin.
+					margin = (<int64_t> space.width * space.height) - imageArea
+					if margin >= lowestMargin:
+						continue
+
+					# Try anchoring the image to all corners of the empty space
+					# until it no longer crosses the texture page boundary. If
+					# no corner is suitable, skip this empty space. As the
+					# horizontal and vertical boundaries are independent, each
+					# axis is only checked once for each side of the space.
+					marginX = space.width  - width
+					marginY = space.height - height
+
+					fitsLeft   = _fitsInTexpage(space.x,           width,  texpageWidth)
+					fitsRight  = _fitsInTexpage(space.x + marginX, width,  texpageWidth)
+					fitsTop    = _fitsInTexpage(space.y,           height, 256)
+					fitsBottom = _fitsInTexpage(space.y + marginY, height, 256)
+
+					if fitsLeft and fitsTop:
+						offsetX, offsetY = 0, 0
+					elif fitsRight and fitsTop:
+						offsetX, offsetY = marginX, 0
+					elif fitsLeft and fitsBottom:
+						offsetX, offsetY = 0, marginY
+					elif fitsRight and fitsBottom:
+						offsetX, offsetY = marginX, marginY
+					else:
+						continue
+
+					lowestIndex   = index
+					lowestOffsetX = offsetX
+					lowestOffsetY = offsetY
+					lowestMargin  = margin
+
+				if lowestIndex < 0:
+					continue
+
+				# If at least one suitable empty space was found, remove it
+				# from the list and possibly replace with two smaller
+				# rectangles representing the empty margins remaining after
+				# placement. There are quite a few potential cases here:
+				# - Both dimensions match the available space's dimensions
+				#   => add no new empty spaces
+				# - Only one dimension equals the space's respective dimension
+				#   => add a single space
+				# - Both dimensions are smaller, and the image is not square
+				#   => add two spaces, trying to keep both as close to a
+				#      square as possible by using the image's longest side as
+				#      a splitting axis (or the shortest side if altSplit =
+				#      True)
+				#
+				# The new spaces take the removed space's place in the list.
+				# The first one simply overwrites it, so at most one insertion
+				# is needed and the list's order (which determines how ties are
+				# broken) is the same as if the space had been removed and the
+				# new ones inserted in its place.
+				space    = spaces[lowestIndex]
+				numSplit = 0
+
+				marginX = space.width  - width
+				marginY = space.height - height
+				padLeft = 0 if lowestOffsetX else width
+				padTop  = 0 if lowestOffsetY else height
+
+				if altSplit != (
+					(<int64_t> space.width  * marginY) <
+					(<int64_t> space.height * marginX)
+				):
+					# Split along bottom side (horizontally)
+					if marginX:
+						split[numSplit] = _PackingSpace(
+							space.x + padLeft, space.y + lowestOffsetY,
+							marginX, height
+						)
+						numSplit += 1
+					if marginY:
+						split[numSplit] = _PackingSpace(
+							space.x, space.y + padTop, space.width, marginY
+						)
+						numSplit += 1
+				else:
+					# Split along right side (vertically)
+					if marginY:
+						split[numSplit] = _PackingSpace(
+							space.x + lowestOffsetX, space.y + padTop,
+							width, marginY
+						)
+						numSplit += 1
+					if marginX:
+						split[numSplit] = _PackingSpace(
+							space.x + padLeft, space.y, marginX, space.height
+						)
+						numSplit += 1
+
+				if not numSplit:
+					spaces.erase(spaces.begin() + lowestIndex)
+				else:
+					spaces[lowestIndex] = split[0]
+				if numSplit == 2:
+					spaces.insert(spaces.begin() + lowestIndex + 1, split[1])
+
+				output[image, 0] = space.x + lowestOffsetX
+				output[image, 1] = space.y + lowestOffsetY
+				output[image, 2] = flipModes[image, flipIndex]
+
+				area   += imageArea
+				packed += 1
+				break
+
+	return area, packed
+
+## String hashing
+
+# http://www.cse.yorku.ca/~oz/hash.html
+
+def sdbmHash(const uint8_t[::1] data, uint32_t value = 0):
+	# (value << 6) + (value << 16) - value is the same as value * 65599, and
+	# unsigned integers already wrap around at 32 bits. Since the hash is a
+	# polynomial in 65599, each block of 8 bytes can be folded in at once as
+	# value * 65599^8 + data[0] * 65599^7 + ... + data[7], where the 8 products
+	# are independent and can be computed in parallel by the compiler.
+	cdef uint32_t   powers[9]
+	cdef uint32_t   block
+	cdef Py_ssize_t index, offset
+	cdef Py_ssize_t length = data.shape[0]
+	cdef Py_ssize_t blocks = length - (length % 8)
+
+	powers[0] = 1
+	for index in range(1, 9):
+		powers[index] = powers[index - 1] * 65599
+
+	with nogil:
+		for index in range(0, blocks, 8):
+			block = 0
+
+			for offset in range(8):
+				block += data[index + offset] * powers[7 - offset]
+
+			value = value * powers[8] + block
+
+		for index in range(blocks, length):
+			value = data[index] + (value << 6) + (value << 16) - value
+
+	return value
+
+cdef inline uint32_t _fastModulo(
+	uint32_t value, uint64_t reciprocal, uint32_t divisor
+) nogil:
+	# Computes value % divisor without a division, given a precomputed
+	# reciprocal of (2^64 - 1) // divisor + 1 (see Lemire et al., "Faster
+	# Remainder by Direct Computation"). The upper 64 bits of the 96-bit
+	# product are calculated in two halves to avoid relying on 128-bit types.
+	cdef uint64_t fraction = reciprocal * value
+	cdef uint64_t high     = fraction >> 32
+	cdef uint64_t low      = <uint32_t> fraction
+
+	return <uint32_t> ((high * divisor + ((low * divisor) >> 32)) >> 32)
+
+def countUsedBuckets(
+	const uint32_t[::1] hashes,
+	int64_t[::1]        output,
+	uint32_t            minBuckets
+):
+	# Simulates hash tables with a number of buckets ranging from minBuckets to
+	# minBuckets + len(output) - 1, and fills in output with how many buckets
+	# end up holding at least one of the given hashes for each length. A single
+	# scratch buffer is reused for all lengths.
+	if output.shape[0] and not minBuckets:
+		raise ValueError("hash tables must have at least one bucket")
+
+	cdef vector[uint8_t] used
+	cdef Py_ssize_t      index, offset
+	cdef uint32_t        numBuckets, bucket
+	cdef uint64_t        reciprocal
+	cdef int64_t         count
+
+	with nogil:
+		for offset in range(output.shape[0]):
+			numBuckets = minBuckets + <uint32_t> offset
+			reciprocal = (UINT64_MAX // numBuckets) + 1
+			count      = 0
+
+			used.assign(numBuckets, 0)
+
+			# Marking the buckets first and counting them afterwards avoids an
+			# unpredictable branch for each hash.
+			for index in range(hashes.shape[0]):
+				used[_fastModulo(hashes[index], reciprocal, numBuckets)] = 1
+			for bucket in range(numBuckets):
+				count += used[bucket]
+
+			output[offset] = count
+
+## Comment stripping
+
+# This is a single-pass replacement for the comment regexes previously used by
+# util.parseText(). The text is scanned as UTF-8 (all delimiters are ASCII, so
+# multi-byte characters never need to be decoded). Unterminated strings and
+# block comments are kept as-is, as if they were regular text.
+
+cpdef enum CommentMode:
+	COMMENT_SHELL  = 0
+	COMMENT_PYTHON = 1
+	COMMENT_JS     = 2
+
+cdef inline Py_ssize_t _findLineEnd(
+	const uint8_t *data, Py_ssize_t index, Py_ssize_t length
+) nogil:
+	while (index < length) and (data[index] != c'\n'):
+		index += 1
+
+	return index
+
+cdef inline Py_ssize_t _findTerminator(
+	const uint8_t *data,
+	Py_ssize_t    index,
+	Py_ssize_t    length,
+	const char    *terminator,
+	Py_ssize_t    terminatorLength
+) nogil:
+	# Returns the index past the first occurrence of the terminator, or -1 if
+	# not found.
+	cdef Py_ssize_t offset
+
+	while (index + terminatorLength) <= length:
+		for offset in range(terminatorLength):
+			if data[index + offset] != terminator[offset]:
+				break
+		else:
+			return index + terminatorLength
+
+		index += 1
+
+	return -1
+
+cdef inline Py_ssize_t _skipString(
+	const uint8_t *data, Py_ssize_t index, Py_ssize_t length
+) nogil:
+	# Returns the index past the closing quote of the string starting at the
+	# given index, or -1 if the string is not terminated on the same line.
+	cdef uint8_t quote = data[index], char
+
+	index += 1
+
+	while index < length:
+		char = data[index]
+
+		if char == quote:
+			return index + 1
+		if char == c'\n':
+			return -1
+		if char == c'\\':
+			if ((index + 1) >= length) or (data[index + 1] == c'\n'):
+				return -1
+
+			index += 2
+		else:
+			index += 1
+
+	return -1
+
+def stripComments(const uint8_t[::1] data, CommentMode mode):
+	cdef Py_ssize_t length = data.shape[0]
+
+	output = bytearray(length)
+	cdef uint8_t[::1] outputData = output
+
+	cdef const uint8_t *source = &data[0] if length else NULL
+	cdef Py_ssize_t    index = 0, end, outputLength = 0
+	cdef uint8_t       char, next
+	cdef bint          keep
+
+	with nogil:
+		while index < length:
+			char = source[index]
+			next = source[index + 1] if ((index + 1) < length) else 0
+			end  = index + 1
+			keep = True
+
+			if (char == c'#') and (mode != COMMENT_JS):
+				end  = _findLineEnd(source, index, length)
+				keep = False
+			elif (char == c'/') and (mode == COMMENT_JS) and (next == c'/'):
+				end  = _findLineEnd(source, index, length)
+				keep = False
+			elif (char == c'/') and (mode == COMMENT_JS) and (next == c'*'):
+				end  = _findTerminator(source, index + 2, length, b"*/", 2)
+				keep = (end < 0)
+			elif (
+				(char == c'"' or char == c"'") and (mode == COMMENT_PYTHON) and
+				(next == char) and ((index + 2) < length) and
+				(source[index + 2] == char)
+			):
+				# Python docstrings are treated as block comments.
+				if char == c'"':
+					end = _findTerminator(source, index + 3, length, b'"""', 3)
+				else:
+					end = _findTerminator(source, index + 3, length, b"'''", 3)
+
+				keep = (end < 0)
+			elif char == c'"' or char == c"'":
+				end = _skipString(source, index, length)
+
+			# Keep only the current character if a string or block comment was
+			# not terminated.
+			if end < 0:
+				end = index + 1
+			# CRLF line endings are also converted to LF here and null bytes
+			# are removed. As comments can't start with a line break, the LF is
+			# always kept whenever the CR preceding it is.
+			if keep:
+				while index < end:
+					char = source[index]
+
+					if not (char == 0 or (
+						(char == c'\r') and ((index + 1) < length) and
+						(source[index + 1] == c'\n')
+					)):
+						outputData[outputLength] = char
+						outputLength += 1
+
+					index += 1
+
+			index = end
+
+	return output[0:outputLength]
+
 ## Internal low-level ADPCM encoder
 
 # https://psx-spx.consoledev.net/cdromdrive/#cdrom-xa-audio-adpcm-compression
@@ -11,152 +11,128 @@ https://github.com/TeamHypersomnia/rectpack2D
 """
 
 import logging
-from itertools import accumulate
+from itertools import accumulate, product
 
 import numpy
-from .image import ImageWrapper
+from .image  import TEXPAGE_WIDTH, ImageWrapper
+from .native import attemptPacking
 
 ## Texture/palette packer
 
 # Sorting doesn't take the images' color depths and packed widths into account.
+# Each function takes arrays of inner widths and heights and returns an array of
+# sorting keys.
 SORT_ORDERS = (
-	lambda image: image.innerWidth * image.innerHeight,
-	lambda image: (image.innerWidth + image.innerHeight) * 2,
-	lambda image: max(image.innerWidth, image.innerHeight),
-	lambda image: image.innerWidth,
-	lambda image: image.innerHeight,
-	lambda image: image.getPathologicalMult()
+	lambda width, height: width * height,
+	lambda width, height: (width + height) * 2,
+	lambda width, height: numpy.maximum(width, height),
+	lambda width, height: width,
+	lambda width, height: height,
+	lambda width, height: \
+		(width * height) * numpy.maximum(width, height) / \
+		numpy.minimum(width, height)
 )
 
-def _attemptPacking(images, atlasWidth, atlasHeight, page, altSplit):
-	# Start with a single empty space representing the entire atlas.
-	spaces = [
-		( 0, 0, atlasWidth, atlasHeight )
-	]
+def _buildArrays(images):
+	# Gather all the properties of the images the packer needs into arrays, in
+	# the format expected by the native module (see native.pyx for a
+	# description of the algorithm used). As the image's actual width in the
+	# texture page depends on its color depth (i.e. indexed color images are
+	# always squished horizontally), the packed size has to be calculated for
+	# each orientation.
+	flipModes = [ ( *image.flipModes, False )[0:2] for image in images ]
+
+	sizes = numpy.array([
+		( image.getPackedSize(modes[0]), image.getPackedSize(modes[1]) )
+		for image, modes in zip(images, flipModes)
+	], numpy.int32).reshape(( -1, 2, 2 ))
+	flipModes     = numpy.array(flipModes, numpy.uint8).reshape(( -1, 2 ))
+	numFlipModes  = numpy.array(
+		[ len(image.flipModes) for image in images ], numpy.uint8
+	)
+	texpageWidths = numpy.array(
+		[ TEXPAGE_WIDTH * (image.bpp // 4) for image in images ], numpy.int32
+	)
+
+	return sizes, flipModes, numFlipModes, texpageWidths
+
+def _attemptPacking(arrays, atlasWidth, atlasHeight, altSplit, output = None):
+	if output is None:
+		output = numpy.empty(( arrays[0].shape[0], 3 ), numpy.int32)
+
+	return attemptPacking(*arrays, output, atlasWidth, atlasHeight, altSplit)
+
+def _tryOrder(
+	arrays, keys, reverse, logString, atlasWidth, atlasHeight, discardStep,
+	splitModes
+):
+	# Negating the keys (rather than reversing the sorted indices) keeps the
+	# sort stable in both directions, like sorted() does.
+	indices   = numpy.argsort(-keys if reverse else keys, kind = "stable")
+	_arrays   = tuple(array[indices] for array in arrays)
+	numImages = indices.shape[0]
+
+	newWidth  = atlasWidth
+	newHeight = atlasHeight
+	packed    = None
+	step      = min(atlasWidth, atlasHeight) // 2
+
+	while step >= discardStep:
+		# Try decreasing the width, height and both, and calculate the
+		# packing ratio for each case.
+		packResults = [] # packed, ratio
+
+		altWidth   = newWidth  - step
+		altHeight  = newHeight - step
+		candidates = (
+			( altWidth, altHeight ),
+			( altWidth, newHeight ),
+			( newWidth, altHeight ),
+			( newWidth, newHeight )
+		)
 
-	area   = 0
-	packed = 0
-	hashes = {} # hash: image
+		for altSplit in splitModes:
+			for width, height in candidates:
+				results = _attemptPacking(
+					_arrays, width, height, altSplit
+				)
+				packResults.append(results)
+
+		# Find the case that led to the highest packing area. Stop once
+		# the atlas can't be further shrunk down nor needs to be
+		# enlarged, or if we're trying to exceed the maximum size.
+		bestResult   = max(packResults)
+		bestIndex    = packResults.index(bestResult) % 4
+		area, packed = bestResult
+
+		# If all attempts to shrink the size led to an increase in
+		# failures, increase both dimensions by the current step and
+		# try shrinking again; otherwise, accept the new sizes and
+		# continue shrinking. Stop once all images have been packed or
+		# if we're trying to exceed the maximum atlas size.
+		if bestIndex == 3 or bestIndex == 7:
+			if packed == numImages:
+				logging.debug(f"{logString}: all images packed, aborting search")
+				break
 
-	for image in images:
-		# Remove duplicate images by skipping an image if its hash matches the
-		# one of another image. Note that hashing relies on palettes being
-		# sorted with the same criteria across all images.
-		# TODO: speed up packing by only performing this check ahead of time in
-		# packImages() or buildAtlases()
-		if (_hash := image.getHash()) in hashes:
-			_image = hashes[_hash]
-
-			image.x    = _image.x
-			image.y    = _image.y
-			image.page = _image.page
-			image.flip = _image.flip
-			packed    += 1
-			continue
-
-		image.x    = None
-		image.y    = None
-		image.page = None
-
-		# Try placing the texture in either orientation. As the image's actual
-		# width in the texture page depends on its color depth (i.e. indexed
-		# color images are always squished horizontally), we have to calculate
-		# it in either case.
-		for flip in image.flipModes:
-			width, height = image.getPackedSize(flip)
-
-			# Find the smallest available space the image can be placed into.
-			# This implementation is slightly different from rectpack2D as it
-			# always goes through all empty spaces, which is inefficient but
-			# might lead to better packing ratios, and ensures images are not
-			# placed in the middle of the atlas (where they'd be split across
-			# two different PS1 texture pages).
-			lowestIndex  = None
-			lowestOffset = None
-			lowestMargin = 1e10
-
-			for index, space in enumerate(spaces):
-				x, y, maxWidth, maxHeight = space
-				if width > maxWidth or height > maxHeight:
-					continue
-
-				# Try anchoring the image to all corners of the empty space
-				# until it no longer crosses the texture page boundary. If no
-				# corner is suitable, skip this empty space.
-				offset  = None
-				marginX = maxWidth  - width
-				marginY = maxHeight - height
-
-				for offsetX, offsetY in (
-					( 0,       0 ),
-					( marginX, 0 ),
-					( 0,       marginY ),
-					( marginX, marginY )
-				):
-					if image.canBePlaced(x + offsetX, y + offsetY, flip):
-						offset = offsetX, offsetY
-						break
+			if (
+				(newWidth + step) > atlasWidth or
+				(newHeight + step) > atlasHeight
+			):
+				logging.debug(f"{logString}: can't extend atlas, aborting search")
+				break
 
-				if offset is None:
-					continue
-
-				margin = (maxWidth * maxHeight) - (width * height)
-				if margin < lowestMargin:
-					lowestIndex  = index
-					lowestOffset = offset
-					lowestMargin = margin
-
-			# If at least one suitable empty space was found, remove it from
-			# the list and possibly replace with two smaller rectangles
-			# representing the empty margins remaining after placement.
-			if lowestIndex is None:
-				continue
-
-			x, y, maxWidth, maxHeight = spaces.pop(lowestIndex)
-			offsetX, offsetY          = lowestOffset
-
-			# There are quite a few potential cases here:
-			# - Both dimensions match the available space's dimensions
-			#   => add no new empty spaces
-			# - Only one dimension equals the space's respective dimension
-			#   => add a single space
-			# - Both dimensions are smaller, and the image is not square
-			#   => add two spaces, trying to keep both as close to a square as
-			#      possible by using the image's longest side as a splitting
-			#      axis (or the shortest side if altSplit = True)
-			marginX = maxWidth  - width
-			marginY = maxHeight - height
-			padLeft = 0 if offsetX else width
-			padTop  = 0 if offsetY else height
-
-			if altSplit != (maxWidth * marginY < maxHeight * marginX):
-				# Split along bottom side (horizontally)
-				if marginY: spaces.insert(lowestIndex,
-					( x, y + padTop, maxWidth, marginY )
-				)
-				if marginX: spaces.insert(lowestIndex,
-					( x + padLeft, y + offsetY, marginX, height )
-				)
-			else:
-				# Split along right side (vertically)
-				if marginX: spaces.insert(lowestIndex,
-					( x + padLeft, y, marginX, maxHeight )
-				)
-				if marginY: spaces.insert(lowestIndex,
-					( x + offsetX, y + padTop, width, marginY )
-				)
+			newWidth  += step
+			newHeight += step
+		else:
+			newWidth, newHeight = candidates[bestIndex % 4]
 
-			image.x       = x + offsetX
-			image.y       = y + offsetY
-			image.page    = page
-			image.flip    = flip
-			hashes[_hash] = image
+		step //= 2
 
-			area   += width * height
-			packed += 1
-			break
+	logging.debug(f"{logString}: {newWidth}x{newHeight}, {packed} images packed")
 
-	return area, packed
+	return area, packed, \
+		( indices, _arrays, newWidth, newHeight, (bestIndex > 3) )
 
 def packImages(images, atlasWidth, atlasHeight, page, discardStep, trySplits):
 	"""
@@ -169,83 +145,107 @@ def packImages(images, atlasWidth, atlasHeight, page, discardStep, trySplits):
 	highestArgs = None
 	highestArea = 0
 
-	for reverse in ( True, False ):
-		for orderIndex, order in enumerate(SORT_ORDERS):
-			logString = f"sort criterion {orderIndex}{' rev' if reverse else ''}"
-			_images   = sorted(images, key = order, reverse = reverse)
-
-			newWidth  = atlasWidth
-			newHeight = atlasHeight
-			packed    = None
-			step      = min(atlasWidth, atlasHeight) // 2
-
-			while step >= discardStep:
-				# Try decreasing the width, height and both, and calculate the
-				# packing ratio for each case.
-				packResults = [] # packed, ratio
-
-				altWidth   = newWidth  - step
-				altHeight  = newHeight - step
-				candidates = (
-					( altWidth, altHeight ),
-					( altWidth, newHeight ),
-					( newWidth, altHeight ),
-					( newWidth, newHeight )
-				)
-
-				for altSplit in splitModes:
-					for width, height in candidates:
-						results = _attemptPacking(
-							_images, width, height, page, altSplit
-						)
-						packResults.append(results)
-
-				# Find the case that led to the highest packing area. Stop once
-				# the atlas can't be further shrunk down nor needs to be
-				# enlarged, or if we're trying to exceed the maximum size.
-				bestResult   = max(packResults)
-				bestIndex    = packResults.index(bestResult) % 4
-				area, packed = bestResult
-
-				# If all attempts to shrink the size led to an increase in
-				# failures, increase both dimensions by the current step and
-				# try shrinking again; otherwise, accept the new sizes and
-				# continue shrinking. Stop once all images have been packed or
-				# if we're trying to exceed the maximum atlas size.
-				if bestIndex == 3 or bestIndex == 7:
-					if packed == len(images):
-						logging.debug(f"{logString}: all images packed, aborting search")
-						break
-
-					if (
-						(newWidth + step) > atlasWidth or
-						(newHeight + step) > atlasHeight
-					):
-						logging.debug(f"{logString}: can't extend atlas, aborting search")
-						break
-
-					newWidth  += step
-					newHeight += step
-				else:
-					newWidth, newHeight = candidates[bestIndex % 4]
-
-				step //= 2
+	# Remove duplicate images ahead of time by comparing their hashes, so that
+	# only unique images go through the packing attempts. Note that hashing
+	# relies on palettes being sorted with the same criteria across all images.
+	hashes     = {} # hash: image
+	duplicates = [] # image, original
 
-			logging.debug(f"{logString}: {newWidth}x{newHeight}, {packed} images packed")
+	for image in images:
+		original = hashes.setdefault(image.getHash(), image)
+
+		if original is not image:
+			duplicates.append(( image, original ))
+
+	uniqueImages = tuple(hashes.values())
+
+	# The images' properties are only extracted once. Each sorting criterion
+	# then reorders the resulting arrays rather than the images themselves.
+	# The sort keys are also only evaluated once for both sorting directions.
+	arrays   = _buildArrays(uniqueImages)
+	widths   = numpy.array(
+		[ image.innerWidth for image in uniqueImages ], numpy.int64
+	)
+	heights  = numpy.array(
+		[ image.innerHeight for image in uniqueImages ], numpy.int64
+	)
+	sortKeys = tuple(order(widths, heights) for order in SORT_ORDERS)
+
+	# The packed size of 4/8bpp images depends on their orientation, so the
+	# largest area any attempt can reach is the sum of each image's largest
+	# packed area among its allowed orientations.
+	maxArea = sum(
+		max(
+			width * height
+			for width, height in map(image.getPackedSize, image.flipModes)
+		) for image in uniqueImages
+	)
+
+	for reverse, ( orderIndex, keys ) in product(
+		( True, False ), enumerate(sortKeys)
+	):
+		area, packed, args = _tryOrder(
+			arrays,
+			keys,
+			reverse,
+			f"sort criterion {orderIndex}{' rev' if reverse else ''}",
+			atlasWidth,
+			atlasHeight,
+			discardStep,
+			splitModes
+		)
 
-			if area > highestArea:
-				highestArgs = _images, newWidth, newHeight, page, (bestIndex > 3)
-				highestArea = area
+		if area > highestArea:
+			highestArgs = args
+			highestArea = area
 
-				# Stop trying other sorting algorithms if all images have been
-				# packed.
-				if packed == len(images):
-					break
+			# Skip other sorting algorithms (in either direction) once the
+			# packed area reaches the upper bound, as no other attempt can
+			# result in a larger packed area. Packing all images is not enough,
+			# as another attempt may flip them into larger packed sizes.
+			if area >= maxArea:
+				logging.debug("largest possible area packed, skipping other criteria")
+				break
 
 	if not highestArea:
+		for image in images:
+			image.x    = None
+			image.y    = None
+			image.page = None
+
 		return 0, 0
 
-	return _attemptPacking(*highestArgs)
+	# Repeat the best packing attempt and copy the resulting placement of each
+	# image back into its attributes.
+	indices, _arrays, width, height, altSplit = highestArgs
+
+	output       = numpy.empty(( len(uniqueImages), 3 ), numpy.int32)
+	area, packed = _attemptPacking(_arrays, width, height, altSplit, output)
+
+	for index, ( x, y, flip ) in zip(indices.tolist(), output.tolist()):
+		image = uniqueImages[index]
+
+		if flip < 0:
+			image.x    = None
+			image.y    = None
+			image.page = None
+		else:
+			image.x    = x
+			image.y    = y
+			image.page = page
+			image.flip = bool(flip)
+
+	# Give each duplicate the same placement as the image it's identical to.
+	for image, original in duplicates:
+		image.x    = original.x
+		image.y    = original.y
+		image.page = original.page
+		image.flip = original.flip
+
+		if original.page is not None:
+			packed += 1
+
+	return area, packed
 
 def packPalettes(images, atlasWidth, atlasHeight, page, preserveLSB = False):
 	"""
@@ -254,48 +254,72 @@ def packPalettes(images, atlasWidth, atlasHeight, page, preserveLSB = False):
 	accordingly. Returns a ( freeHeight, numPackedPalettes ) tuple.
 	"""
 
-	hashes = {} # hash: image
-	packed = 0
-	px, py = 0, atlasHeight - 1
-
 	# Sort images by their color depth to make sure all 256-color palettes get
 	# packed first.
-	for image in sorted(
-		images,
-		key     = lambda image: image.bpp,
-		reverse = True
+	_images = [
+		image for image in sorted(
+			images,
+			key     = lambda image: image.bpp,
+			reverse = True
+		) if (2 ** image.bpp) <= atlasWidth
+	]
+
+	# Remove duplicate/similar palettes by comparing their hashes. The LSB of
+	# each RGB value is masked off (see getPaletteHash()) to remove palettes
+	# that are close enough to another palette. As usual the palettes have to
+	# be sorted ahead of time for this to work.
+	hashes         = {} # hash: index
+	uniqueImages   = []
+	firstPositions = []
+	originals      = []
+
+	for position, image in enumerate(_images):
+		index = hashes.setdefault(image.getPaletteHash(preserveLSB), len(hashes))
+
+		if index == len(uniqueImages):
+			uniqueImages.append(image)
+			firstPositions.append(position)
+
+		originals.append(index)
+
+	# Lay out all unique palettes one after another, wrapping around to the row
+	# above when the end of a row is reached. Stop after the first palette that
+	# ends past the top of the atlas (it still gets placed, as it starts within
+	# the atlas).
+	widths  = numpy.array(
+		[ 2 ** image.bpp for image in uniqueImages ], numpy.int64
+	)
+	ends    = numpy.cumsum(widths)
+	offsets = ends - widths
+	overrun = numpy.flatnonzero((ends // atlasWidth) >= atlasHeight)
+
+	if overrun.size:
+		numPlaced = int(overrun[0]) + 1
+		_images   = _images[0:firstPositions[numPlaced - 1] + 1]
+	else:
+		numPlaced = len(uniqueImages)
+
+	for image, offset in zip(
+		uniqueImages[0:numPlaced], offsets[0:numPlaced].tolist()
 	):
-		#if image.bpp == 16:
-			#continue
-		if (width := 2 ** image.bpp) > atlasWidth:
-			continue
-
-		# Remove duplicate/similar palettes by comparing their hashes. The LSB
-		# of each RGB value is masked off (see getPaletteHash()) to remove
-		# palettes that are close enough to another palette. As usual the
-		# palettes have to be sorted ahead of time for this to work.
-		_hash = image.getPaletteHash(preserveLSB)
-
-		if (_image := hashes.get(_hash, None)) is not None:
+		image.px          = (offset % atlasWidth) // 16
+		image.py          = atlasHeight - 1 - offset // atlasWidth
+		image.palettePage = page
+
+	packed = numPlaced
+
+	for image, index in zip(_images, originals):
+		_image = uniqueImages[index]
+
+		if image is not _image:
 			image.px          = _image.px
 			image.py          = _image.py
 			image.palettePage = page
 
 			packed += 1
-			continue
-
-		image.px          = px // 16
-		image.py          = py
-		image.palettePage = page
-		hashes[_hash]     = image
-
-		packed += 1
-		px     += width
-		py     -= px // atlasWidth
-		px     %= atlasWidth
 
-		if py < 0:
-			break
+	cursor = int(ends[numPlaced - 1]) if numPlaced else 0
+	px, py = cursor % atlasWidth, atlasHeight - 1 - cursor // atlasWidth
 
 	return py + (0 if px else 1), packed
 
@@ -315,8 +339,11 @@ def buildAtlases(
 	Takes an iterable of ImageWrapper objects, packs them and yields a series
 	of NumPy arrays representing texture atlases. The size (width) of each
 	atlas may vary from 64 to 256 pixels, depending on what needs to be packed.
+	Note that all atlases are views into the same buffer, which gets reused for
+	the next atlas; they must be copied if they are to be kept.
 	"""
 
+	buffer    = numpy.empty(( ATLAS_HEIGHT, ATLAS_MAX_WIDTH * 2 ), numpy.uint8)
 	_images   = images
 	_palettes = list(filter(lambda image: image.bpp != 16, images))
 	index     = 0
@@ -354,7 +381,8 @@ def buildAtlases(
 
 		# Collect the images and palettes that couldn't be packed and blit
 		# everything else onto the atlas.
-		atlas = numpy.zeros(( ATLAS_HEIGHT, atlasWidth * 2 ), numpy.uint8)
+		atlas = buffer[:, 0:(atlasWidth * 2)]
+		atlas.fill(0)
 
 		unpackedImages   = []
 		unpackedPalettes = []
@@ -409,9 +437,11 @@ def buildTexturePages(
 		bucket          = buckets[bucketIndex]
 		indexMap[index] = bucketIndex, len(bucket)
 
-		# Split the atlas into 64x256 texture pages.
+		# Split the atlas into 64x256 texture pages. Each page is copied out of
+		# the atlas, as the atlas buffer is reused by buildAtlases() (this also
+		# makes the pages contiguous in memory).
 		for offset in range(0, width, ATLAS_MIN_WIDTH * 2):
-			bucket.append(atlas[:, offset:(offset + ATLAS_MIN_WIDTH * 2)])
+			bucket.append(atlas[:, offset:(offset + ATLAS_MIN_WIDTH * 2)].copy())
 
 	# As all buckets are going to be concatenated, calculate the texture page
 	# offset each bucket is going to end up at, then derive the absolute texture
@@ -4,6 +4,8 @@
 import re, json, logging
 from collections import defaultdict
 from xml.etree   import ElementTree
+from pathlib     import Path
+from functools   import lru_cache
 
 from PIL   import Image
 from .util import parseRange, parseText, parseJSON, parseKeyValue, CaseDict
@@ -29,6 +31,29 @@ def importKeyValue(paths, constructor = dict):
 
 	return obj
 
+## Image loader
+
+IMAGE_CACHE_SIZE = 64
+
+@lru_cache(maxsize = IMAGE_CACHE_SIZE)
+def _loadImage(path, mtime, size):
+	# Decoding is deferred until the image is first used (e.g. cropped), after
+	# which the decoded data is kept in the cached image object.
+	return Image.open(path, "r")
+
+def loadImage(path):
+	"""
+	Opens an image file lazily, caching it so that files referenced by multiple
+	entries (e.g. spritesheets) only have to be decoded once. Only the most
+	recently used images are kept in the cache. The returned image is shared
+	with other callers and must not be modified or closed.
+	"""
+
+	path = Path(path).resolve()
+	stat = path.stat()
+
+	return _loadImage(path, stat.st_mtime_ns, stat.st_size)
+
 ## Texture atlas parsers
 
 ANIM_FRAME_REGEX  = re.compile(r"^(.+?)\s*([0-9]{1,4})$")
@@ -42,7 +67,7 @@ def _parseXMLAtlas(path):
 
 		# If the image path is not absolute, assume it is relative to the atlas
 		# file's location.
-		image   = Image.open(path.parent.joinpath(imagePath), "r")
+		image   = loadImage(path.parent.joinpath(imagePath))
 		entries = defaultdict(dict)
 
 		for texture in atlas.iter("SubTexture"):
@@ -84,7 +109,7 @@ def _parseJSONAtlas(path):
 
 		# If the image path is not absolute, assume it is relative to the atlas
 		# file's location.
-		image   = Image.open(path.parent.joinpath(imagePath), "r")
+		image   = loadImage(path.parent.joinpath(imagePath))
 		entries = defaultdict(dict)
 
 		for name, texture in atlas["frames"].items():
@@ -138,7 +163,7 @@ def _parseTextAtlas(path):
 			frames = entries[name]
 			frames[len(frames)] = entry
 
-	yield Image.open(path.parent.joinpath(f"{path.stem}.png"), "r"), entries
+	yield loadImage(path.parent.joinpath(f"{path.stem}.png")), entries
 
 ## Atlas and glob path handlers
 
@@ -175,33 +200,32 @@ def _processAtlas(atlas):
 	counter = 0
 
 	for image, entries in atlas:
-		with image:
-			for name, frames in entries.items():
-				frameList = []
-
-				for frame in _sortFrames(name, frames):
-					(
-						srcX, srcY, srcW, srcH,
-						dstX, dstY, dstW, dstH, trim
-					) = frame
-
-					# Crop the frame from the source image, then place it onto
-					# a "virtual canvas" to pad it with empty borders (if there
-					# are any).
-					cropped = image.crop(
-						( srcX, srcY, srcX + srcW, srcY + srcH )
-					)
-
-					if trim and (dstX or dstY or dstW != srcW or dstH != srcH):
-						canvas = Image.new(image.mode, ( dstW, dstH ))
-						canvas.paste(cropped, ( dstX, dstY ))
-
-						frameList.append(canvas)
-					else:
-						frameList.append(cropped)
-
-				yield name, frameList
-				counter += 1
+		for name, frames in entries.items():
+			frameList = []
+
+			for frame in _sortFrames(name, frames):
+				(
+					srcX, srcY, srcW, srcH,
+					dstX, dstY, dstW, dstH, trim
+				) = frame
+
+				# Crop the frame from the source image, then place it onto
+				# a "virtual canvas" to pad it with empty borders (if there
+				# are any).
+				cropped = image.crop(
+					( srcX, srcY, srcX + srcW, srcY + srcH )
+				)
+
+				if trim and (dstX or dstY or dstW != srcW or dstH != srcH):
+					canvas = Image.new(image.mode, ( dstW, dstH ))
+					canvas.paste(cropped, ( dstX, dstY ))
+
+					frameList.append(canvas)
+				else:
+					frameList.append(cropped)
+
+			yield name, frameList
+			counter += 1
 
 	logging.debug(f"imported {counter} frame groups from atlas")
 
@@ -215,7 +239,7 @@ def _processGlob(globPath):
 	# (e.g. character0001.png, character0002.png, etc.). Files that lack a
 	# frame number are treated as a single-frame image.
 	for path in paths:
-		image = Image.open(path, "r")
+		image = loadImage(path)
 
 		if _match := ANIM_FRAME_REGEX.match(path.stem):
 			name, frame = _match.groups()
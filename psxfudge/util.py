@@ -6,15 +6,21 @@
 This module contains various helper classes and functions used internally.
 """
 
-import re, math, json
-from time        import gmtime
+import re, json
+from time        import gmtime, time
 from pathlib     import Path
 from collections import UserDict
 from ast         import literal_eval
 from struct      import Struct
 from tempfile    import mkdtemp
+from hashlib     import blake2b
+from functools   import lru_cache
+from itertools   import accumulate
+from bisect      import bisect_right
+from operator    import itemgetter
 
 import numpy
+from .native import sdbmHash, countUsedBuckets, stripComments, CommentMode
 
 ## Array/string/iterator utilities
 
@@ -22,22 +28,35 @@ def blitArray(source, dest, position):
 	"""
 	Copies the contents of the source array to the destination array at the
 	given position (which should be a list or tuple containing an integer for
-	each dimension of the source and destination arrays).
+	each dimension of the source and destination arrays). Any part of the
+	source array that falls outside of the destination array is skipped.
 	"""
 
-	pos = map(lambda x: x if x >= 0 else None, position)
-	neg = map(lambda x: -x if x < 0 else None, position)
+	sourceSlices = []
+	destSlices   = []
+	clipped      = False
 
-	destView = dest[tuple(
-		slice(start, None) for start in pos
-	)]
-	sourceView = source[tuple(
-		slice(start, end) for start, end in zip(neg, destView.shape)
-	)]
+	# Clip the source array's bounds along each axis to the area covered by
+	# the destination array.
+	for sourceLength, destLength, offset in zip(
+		source.shape, dest.shape, position
+	):
+		start = max(0, -offset)
+		end   = min(sourceLength, destLength - offset)
 
-	destView[tuple(
-		slice(None, end) for end in source.shape
-	)] = sourceView
+		if end <= start:
+			return
+
+		sourceSlices.append(slice(start, end))
+		destSlices.append(slice(start + offset, end + offset))
+		clipped |= (start > 0) or (end < sourceLength)
+
+	# Skip slicing the source array in the common case where it fits entirely
+	# within the destination.
+	if clipped:
+		source = source[tuple(sourceSlices)]
+
+	numpy.copyto(dest[tuple(destSlices)], source, casting = "unsafe")
 
 def cropArray(data, value = 0):
 	"""
@@ -45,30 +64,65 @@ def cropArray(data, value = 0):
 	an array and returns a ( data, croppedLeft, croppedRight ) tuple.
 	"""
 
-	indices  = numpy.argwhere(data != value)
-	minBound = indices.min(0)
-	maxBound = indices.max(0) + 1
-
-	cropped = data[tuple(
-		slice(start, end) for start, end in zip(minBound, maxBound)
-	)]
-
-	return cropped, tuple(minBound), tuple(data.shape - maxBound)
+	# Find the bounds along each axis by reducing the mask over all other axes,
+	# rather than collecting the indices of every non-matching item.
+	mask   = (data != value)
+	axes   = range(mask.ndim)
+	slices = []
+
+	for axis in axes:
+		used = numpy.flatnonzero(mask.any(
+			axis = tuple(_axis for _axis in axes if _axis != axis)
+		))
+
+		if not used.size:
+			raise ValueError("array only contains items matching the value")
+
+		slices.append(slice(int(used[0]), int(used[-1]) + 1))
+
+	croppedLeft  = tuple(_slice.start for _slice in slices)
+	croppedRight = tuple(
+		length - _slice.stop for length, _slice in zip(data.shape, slices)
+	)
+
+	return data[tuple(slices)], croppedLeft, croppedRight
+
+@lru_cache(maxsize = 16)
+def _getNibbleTable(highNibbleFirst, shift):
+	# Build a lookup table mapping each possible byte to its two unpacked
+	# nibbles, stored as a little endian 16-bit value, so the whole array can be
+	# unpacked with a single gather and then reinterpreted as bytes. The table
+	# only depends on the arguments, so it's cached across calls.
+	values = numpy.arange(256, dtype = "<u2")
+	low    = ((values & 0xf) << shift) & 0xff
+	high   = ((values >> 4)  << shift) & 0xff
+
+	if highNibbleFirst:
+		return high | (low << 8)
+	else:
+		return low | (high << 8)
 
-def unpackNibbles(data, highNibbleFirst = False):
+def unpackNibbles(data, highNibbleFirst = False, shift = 0):
 	"""
 	Unpacks the low and high nibbles in a NumPy array of bytes and returns a
-	new array whose last dimension is doubled.
+	new array whose last dimension is doubled. Each unpacked nibble can be
+	optionally shifted left by the given number of bits.
 	"""
 
-	length   = numpy.product(data.shape)
-	unrolled = data.reshape(length)
-	unpacked = numpy.zeros(length * 2, data.dtype)
+	table = _getNibbleTable(bool(highNibbleFirst), shift)
+
+	return table[data].view(numpy.uint8)
+
+def hashArray(data):
+	"""
+	Returns a 64-bit hash of the shape and contents of a NumPy array. The array
+	is hashed in-place without copying its data, as long as it's contiguous.
+	"""
 
-	unpacked[(1 if highNibbleFirst else 0)::2] = unrolled & 0xf
-	unpacked[(0 if highNibbleFirst else 1)::2] = (unrolled >> 4) & 0xf
+	_hash = blake2b(str(data.shape).encode("ascii"), digest_size = 8)
+	_hash.update(numpy.ascontiguousarray(data))
 
-	return unpacked.reshape(data.shape[:-1] + ( data.shape[-1] * 2, ))
+	return int.from_bytes(_hash.digest(), "little")
 
 def alignToMultiple(data, length, padding = b"\x00"):
 	"""
@@ -76,8 +130,7 @@ def alignToMultiple(data, length, padding = b"\x00"):
 	multiple of the specified length.
 	"""
 
-	chunks = math.ceil(len(data) / length)
-	return data.ljust(chunks * length, padding)
+	return data.ljust(-(-len(data) // length) * length, padding)
 
 def alignMutableToMultiple(obj, length, padding = b"\x00"):
 	"""
@@ -85,28 +138,20 @@ def alignMutableToMultiple(obj, length, padding = b"\x00"):
 	until its length is a multiple of the specified length.
 	"""
 
-	remaining = length - (len(obj) % length)
-	if remaining < length:
-		obj.extend(padding * remaining)
-
-def hash32(obj):
-	"""
-	Returns the 32-bit "sdbm hash" of a string, byte array or other iterable.
+	if not (remaining := -len(obj) % length):
+		return
 
-	http://www.cse.yorku.ca/~oz/hash.html
-	"""
-
-	if type(obj) is int:
-		return obj
+	# bytes() allocates an already zeroed buffer, which is faster than
+	# repeating the padding when it's a single null byte.
+	if padding == b"\x00":
+		obj.extend(bytes(remaining))
+	else:
+		obj.extend(padding * remaining)
 
+def _hashValues(values):
 	value = 0
 
-	for item in obj:
-		if type(item) is str:
-			byte = ord(item)
-		else:
-			byte = int(item) & 0xff
-
+	for byte in values:
 		value = (
 			byte + \
 			((value <<  6) & 0xffffffff) + \
@@ -116,30 +161,89 @@ def hash32(obj):
 
 	return value
 
+def _hashIterable(obj):
+	return _hashValues(
+		(ord(item) if (type(item) is str) else (int(item) & 0xff))
+		for item in obj
+	)
+
+def _hashString(obj):
+	# Strings made up only of characters in the 0-255 range (i.e. all ASCII
+	# names) are hashed by the native module, as their characters map 1:1 to
+	# latin-1 bytes. Any other string is hashed in Python.
+	try:
+		return sdbmHash(obj.encode("latin-1"))
+	except UnicodeEncodeError:
+		return _hashValues(map(ord, obj))
+
+def _hashMemoryView(obj):
+	if obj.format == "B" and obj.ndim == 1 and obj.c_contiguous:
+		return sdbmHash(obj)
+
+	return _hashIterable(obj)
+
+# The hashing method is picked once based on the object's type, so that the
+# per-item type check is only done for generic iterables. Subclasses of these
+# types also end up being hashed as generic iterables, which gives the same
+# result.
+_HASH32_METHODS = {
+	int:        lambda obj: obj,
+	str:        _hashString,
+	bytes:      sdbmHash,
+	bytearray:  sdbmHash,
+	memoryview: _hashMemoryView
+}
+
+def hash32(obj):
+	"""
+	Returns the 32-bit "sdbm hash" of a string, byte array or other iterable.
+
+	http://www.cse.yorku.ca/~oz/hash.html
+	"""
+
+	return _HASH32_METHODS.get(type(obj), _hashIterable)(obj)
+
 def swapEndianness(value, bits = 32):
-	_value, output = value, 0
+	# Any bits above the given width are discarded (as if the value were cast
+	# to an unsigned integer of that width) before the bytes are swapped. NumPy
+	# arrays are cast to an unsigned type of the given width and swapped
+	# element-wise, so only widths NumPy has an integer type for are supported.
+	length = (bits + 7) // 8
+
+	if isinstance(value, numpy.ndarray):
+		if length not in ( 1, 2, 4, 8 ):
+			raise ValueError(f"unsupported bit width for NumPy arrays: {bits}")
+
+		output = value.astype(f"u{length}")
+		output.byteswap(inplace = True)
 
-	for _ in range(0, bits, 8):
-		output   = (output << 8) | (_value & 0xff)
-		_value >>= 8
+		return output
 
-	return output
+	_value = value & ((1 << (length * 8)) - 1)
+
+	return int.from_bytes(_value.to_bytes(length, "little"), "big")
 
 ## Format conversion
 
-def toMSDOSTime(unixTime = None):
+@lru_cache(maxsize = 1024)
+def _toMSDOSTime(unixTime):
 	_time = gmtime(unixTime)
 	if _time.tm_year < 1980:
 		raise ValueError("invalid year for MS-DOS time format")
 
-	value  = _time.tm_sec  // 2
-	value |= _time.tm_min  << 5
-	value |= _time.tm_hour << 11
-	value |= _time.tm_mday << 16
-	value |= _time.tm_mon  << 21
-	value |= (_time.tm_year - 1980) << 25
+	return \
+		(_time.tm_sec  // 2) | \
+		(_time.tm_min  << 5) | \
+		(_time.tm_hour << 11) | \
+		(_time.tm_mday << 16) | \
+		(_time.tm_mon  << 21) | \
+		((_time.tm_year - 1980) << 25)
 
-	return value
+def toMSDOSTime(unixTime = None):
+	# Timestamps are truncated to whole seconds before being converted (as
+	# gmtime() would do anyway), so that files sharing the same modification
+	# time only go through the conversion once.
+	return _toMSDOSTime(int(time() if unixTime is None else unixTime))
 
 ## String manipulation
 
@@ -154,35 +258,107 @@ def _isWithinBounds(value, minValue = None, maxValue = None):
 
 	return True
 
+def _parseRangeItems(_range):
+	# Converts a range string into ( start, end, stride ) items, with single
+	# values turned into single-item ranges.
+	for _match in RANGE_ITEM_REGEX.finditer(_range):
+		start, end, stride = _match.groups()
+		_start             = int(start, 0)
+
+		if end is None:
+			yield _start, _start, 1
+		else:
+			yield _start, int(end, 0), (1 if stride is None else int(stride, 0))
+
+class Range:
+	"""
+	A parsed range (see parseRange()), which can be iterated over and checked
+	for membership using the "in" operator without parsing the range again.
+	"""
+
+	def __init__(self, _range = ()):
+		self.items = tuple(self._getItems(_range))
+
+		# Sort the items by their lowest value so lookups can be done through a
+		# binary search. As items may overlap, the highest value covered by any
+		# item up to each index is also stored. Empty items are skipped.
+		bounds = [] # low, high, start, stride
+
+		for start, end, stride in self.items:
+			if stride > 0 and start <= end:
+				bounds.append(( start, end, start, stride ))
+			elif stride < 0 and end <= start:
+				bounds.append(( end, start, start, stride ))
+
+		bounds.sort()
+
+		self._bounds   = bounds
+		self._lows     = [ low for low, high, start, stride in bounds ]
+		self._maxHighs = list(accumulate(
+			( high for low, high, start, stride in bounds ), max
+		))
+
+	@staticmethod
+	def _getItems(_range):
+		if isinstance(_range, Range):
+			yield from _range.items
+		elif type(_range) is int:
+			yield _range, _range, 1
+		elif type(_range) is str:
+			yield from _parseRangeItems(_range)
+		else:
+			# Interpret the range as an iterable of strings and/or ints.
+			for item in _range:
+				yield from Range._getItems(item)
+
+	def __contains__(self, value):
+		index = bisect_right(self._lows, value)
+
+		while index:
+			index -= 1
+
+			# Stop once no item at or before this index reaches the value.
+			if self._maxHighs[index] < value:
+				break
+
+			low, high, start, stride = self._bounds[index]
+			if value <= high and not ((value - start) % stride):
+				return True
+
+		return False
+
+	def __iter__(self):
+		for start, end, stride in self.items:
+			yield from range(start, end + stride, stride)
+
+@lru_cache(maxsize = 256)
+def _compileRange(_range):
+	# Range strings are only parsed once, as the same few strings tend to be
+	# used over and over again.
+	return Range(_range)
+
 def parseRange(_range, minValue = None, maxValue = None):
 	"""
 	Parses a string containing space-delimited positive integers, optionally
 	with dashes specifying ranges and colons prefixing strides (e.g.
 	"1 8-10 3-7:2") and yields all values (e.g. [ 1, 8, 9, 10, 3, 5, 7 ]).
+	Range objects are also accepted.
 	"""
 
+	if type(_range) is str:
+		_range = _compileRange(_range)
+
 	if type(_range) is int:
 		if _isWithinBounds(_range, minValue, maxValue):
 			yield _range
 
-	elif type(_range) is str:
-		for _match in RANGE_ITEM_REGEX.finditer(_range):
-			start, end, stride = _match.groups()
-
-			if end is None:
-				value = int(start, 0)
-
-				if _isWithinBounds(value, minValue, maxValue):
-					yield value
-			else:
-				_start, _end = int(start, 0), int(end, 0)
-				_stride      = 1 if stride is None else int(stride, 0)
-
-				yield from range(
-					(_start if minValue is None else max(minValue, _start)),
-					(_end   if maxValue is None else min(maxValue, _end)) + _stride,
-					_stride
-				)
+	elif isinstance(_range, Range):
+		for start, end, stride in _range.items:
+			yield from range(
+				(start if minValue is None else max(minValue, start)),
+				(end   if maxValue is None else min(maxValue, end)) + stride,
+				stride
+			)
 
 	else:
 		# Interpret the range as an iterable of strings and/or ints.
@@ -194,27 +370,18 @@ def isWithinRange(value, _range):
 	Parses a string containing space-delimited positive integers, optionally
 	with dashes specifying ranges and colons prefixing strides (e.g.
 	"1 8-10 3-7:2") and checks whether the given value is within the range.
+	Range objects are also accepted, and should be used when checking many
+	values against the same range.
 	"""
 
+	if type(_range) is str:
+		_range = _compileRange(_range)
+
 	if type(_range) is int:
 		return (value == _range)
 
-	elif type(_range) is str:
-		for _match in RANGE_ITEM_REGEX.finditer(_range):
-			start, end, stride = _match.groups()
-
-			if end is None:
-				if value == int(start, 0):
-					return True
-			else:
-				_start, _end = int(start, 0), int(end, 0)
-				_stride      = 1 if stride is None else int(stride, 0)
-
-				if \
-					(_stride > 0 and value >= _start and value <= _end) or \
-					(_stride < 0 and value <= _start and value >= _end):
-					if not ((value - _start) % int(stride, 0)):
-						return True
+	elif isinstance(_range, Range):
+		return (value in _range)
 
 	else:
 		# Interpret the range as an iterable of strings and/or ints.
@@ -224,6 +391,30 @@ def isWithinRange(value, _range):
 
 	return False
 
+def _parseQuotedValue(value):
+	# Strings with no escape sequences and no other quotes in them (i.e. most
+	# of them) can simply have their quotes removed.
+	quote, inner = value[0], value[1:-1]
+
+	if (
+		len(value) >= 2 and value.endswith(quote) and
+		quote not in inner and "\\" not in inner
+	):
+		return inner
+
+	# JSON string escapes are a subset of Python's, except for "\/" and the way
+	# surrogate pairs are decoded, so json.loads() (which is much faster than
+	# literal_eval()) can be used for most double-quoted strings. Anything JSON
+	# rejects, such as single quotes or Python-only escapes, falls back to
+	# literal_eval().
+	if value.startswith("\"") and "\\/" not in value and "\\u" not in value:
+		try:
+			return json.loads(value)
+		except ValueError:
+			pass
+
+	return literal_eval(value)
+
 def _parseKeyValue(strings, constructor = dict, separator = "="):
 	obj = constructor()
 
@@ -235,7 +426,7 @@ def _parseKeyValue(strings, constructor = dict, separator = "="):
 		key, value = key.strip(), value.strip()
 
 		if value.startswith(( "\"", "'" )):
-			value = literal_eval(value)
+			value = _parseQuotedValue(value)
 
 		obj[key] = value
 
@@ -252,19 +443,28 @@ def bestHashTableLength(hashes, minLoadFactor = 0.7, chainPenalty = 0.5):
 	associated with the best score.
 	"""
 
-	length    = len(hashes)
-	bestValue = None
-	bestScore = 1e10
+	# Hashes are masked to 32 bits, as integers (which hash32() passes through
+	# unchanged) may not fit into the array otherwise.
+	hashes     = numpy.fromiter(
+		( _hash & 0xffffffff for _hash in hashes ), numpy.uint32
+	)
+	length     = hashes.size
+	numBuckets = numpy.arange(
+		length, round(length / minLoadFactor + 0.5), dtype = numpy.int64
+	)
+
+	if not numBuckets.size:
+		return None
 
-	for numBuckets in range(length, round(length / minLoadFactor + 0.5)):
-		table   = ( _hash % numBuckets for _hash in hashes )
-		chained = numBuckets - len(set(table))
+	# Count how many buckets end up being used for each length, then pick the
+	# length with the lowest score (the first one in case of ties).
+	used = numpy.empty_like(numBuckets)
+	countUsedBuckets(hashes, used, length)
 
-		if (score := numBuckets + chained * chainPenalty) < bestScore:
-			bestValue = numBuckets
-			bestScore = score
+	chained = numBuckets - used
+	scores  = numBuckets + chained * chainPenalty
 
-	return bestValue
+	return int(numBuckets[numpy.argmin(scores)])
 
 ## Path utilities
 
@@ -277,10 +477,10 @@ def iteratePaths(paths):
 
 ## Text file parsing
 
-COMMENT_REGEX = {
-	"shell":  re.compile(r"((?:\".*\"|'.*'|[^\"'])*?)(?:\#.*)?$", re.MULTILINE),
-	"python": re.compile(r"((?:\".*\"|'.*'|[^\"'])*?)(?:(?:\#.*)?$|\"\"\"(?:.|\n)*?\"\"\"|'''(?:.|\n)*?''')", re.MULTILINE),
-	"js":     re.compile(r"((?:\".*\"|'.*'|[^\"'])*?)(?:(?:\/\/.*)?$|\/\*(?:.|\n)*?\*\/)", re.MULTILINE)
+COMMENT_MODES = {
+	"shell":  CommentMode.COMMENT_SHELL,
+	"python": CommentMode.COMMENT_PYTHON,
+	"js":     CommentMode.COMMENT_JS
 }
 
 def parseText(text, commentMode = "shell"):
@@ -288,13 +488,9 @@ def parseText(text, commentMode = "shell"):
 	Returns the given text with all comments stripped out.
 	"""
 
-	regex = COMMENT_REGEX[commentMode.lower()]
+	mode = COMMENT_MODES[commentMode.lower()]
 
-	text = text.replace("\r\n", "\n")
-	text = "".join(regex.findall(text))
-	text = text.replace("\0", "")
-
-	return text
+	return stripComments(text.encode("utf-8"), mode).decode("utf-8")
 
 def parseJSON(text, *a, **k):
 	return json.loads(parseText(text, "js"), *a, **k)
@@ -306,8 +502,22 @@ def parseKeyValue(text, constructor = dict, separator = "="):
 
 ## Case-insensitive dictionary
 
+_normalizedKeys = {} # key: normalizedKey
+
 def _normalizeKey(key):
-	return key.strip().lower() if (type(key) is str) else key
+	# The normalized form of each string key is cached, as the same few keys
+	# (i.e. property names) tend to be looked up over and over again. The cache
+	# stops growing once it gets large, in order to bound memory usage.
+	if type(key) is not str:
+		return key
+	if (normalized := _normalizedKeys.get(key)) is not None:
+		return normalized
+
+	normalized = key.strip().casefold()
+	if len(_normalizedKeys) < 4096:
+		_normalizedKeys[key] = normalized
+
+	return normalized
 
 class CaseDict(UserDict):
 	"""
@@ -328,13 +538,13 @@ class CaseDict(UserDict):
 		return (_normalizeKey(key) in self.data)
 
 	def __iter__(self):
-		return (key for key, value in self.data.values())
+		return map(itemgetter(0), self.data.values())
 
 	#def __repr__(self):
 		#return f"CaseDict({repr(dict(self.data.values()))})"
 
 	def values(self):
-		return (value for key, value in self.data.values())
+		return map(itemgetter(1), self.data.values())
 
 	def items(self):
 		return self.data.values()
@@ -347,7 +557,8 @@ class CacheDirectory:
 	"""
 	A class for managing a cache, i.e. a directory containing temporary files
 	that can be accessed through unique identifier strings. This class is
-	stateless to make parallelization easier.
+	stateless to make parallelization easier (other than keeping track of which
+	subdirectories have already been created).
 	"""
 
 	def __init__(self, path = None, prefixBits = 4):
@@ -358,18 +569,39 @@ class CacheDirectory:
 			self.path = Path(mkdtemp("", CACHE_DIR_PREFIX))
 
 		self.prefixBits = prefixBits
+		self._prefixes  = {} # prefix: path
+
+	def _createPrefix(self, prefix):
+		path = self.path.joinpath(f"{prefix:02x}")
+		path.mkdir(parents = True, exist_ok = True)
+
+		self._prefixes[prefix] = path
+		return path
 
 	def prepare(self):
 		for prefix in range(2 ** self.prefixBits):
-			path = self.path.joinpath(f"{prefix:02x}")
-			path.mkdir(parents = True, exist_ok = True)
+			self._createPrefix(prefix)
 
 	def getPath(self, name):
-		_hash  = hash32(name)
+		# String and buffer names are hashed with BLAKE2 rather than sdbm (which
+		# doesn't have to match the PS1 side here), as its output is spread
+		# evenly across the prefix subdirectories. Any other name (such as an
+		# integer or a generic iterable) still goes through hash32().
+		if type(name) is str:
+			name = name.encode("utf-8")
+
+		if isinstance(name, ( bytes, bytearray, memoryview )):
+			_hash = int.from_bytes(blake2b(name, digest_size = 4).digest(), "big")
+		else:
+			_hash = hash32(name) & 0xffffffff
+
 		prefix = _hash >> (32 - self.prefixBits)
-		path   = self.path.joinpath(f"{prefix:02x}")
 
-		path.mkdir(parents = True, exist_ok = True)
+		# The subdirectory's path is cached along with the fact it exists, so
+		# neither mkdir() nor formatting its name is repeated for each lookup.
+		if (path := self._prefixes.get(prefix)) is None:
+			path = self._createPrefix(prefix)
+
 		return path.joinpath(f"{_hash:08x}.bin")
 
 	def lastModified(self, name):